@@ -0,0 +1,426 @@
+"""
+Latency budget mode for Ollama vision requests
+Learns request timings per (model, server) and picks the image resolution,
+num_predict, num_ctx and prompt variant that fit a target latency
+"""
+
+import base64
+import io
+import json
+import socket
+import threading
+import time
+
+import requests
+from PIL import Image
+from urllib3.exceptions import ReadTimeoutError
+
+# Prompt variants per test: detailed answers from the desktop app, concise ones from the web app
+PROMPTS = {
+    'color': {
+        'detailed': """Analyze the colors in this image in detail. Please:
+1. List all the dominant colors you can identify
+2. Be specific about color shades and tones (e.g., "navy blue" instead of just "blue")
+3. Mention any color gradients or transitions
+4. Identify any color patterns or color schemes
+5. Estimate the percentage of each color in the image""",
+        'concise': "What are the main colors in this image? List them in a single sentence.",
+    },
+    'shape': {
+        'detailed': """Identify and analyze all geometric shapes in this image. Please:
+1. List all shapes you can identify (circles, squares, triangles, rectangles, etc.)
+2. Describe their positions and locations relative to each other
+3. Estimate their sizes and proportions
+4. Identify any patterns or arrangements of shapes
+5. Note any complex shapes or combinations of basic shapes""",
+        'concise': "What geometric shapes do you see in this image? Describe them in one sentence.",
+    },
+    'general': {
+        'detailed': """Provide a comprehensive analysis of this image. Please describe:
+1. All objects and elements you can identify
+2. Colors and their distribution
+3. Shapes and geometric patterns
+4. Spatial relationships between elements
+5. Any text or symbols present
+6. Overall composition and style
+7. Notable details or interesting features""",
+        'concise': "Briefly describe what you see in this image in one or two sentences.",
+    },
+}
+
+# Longest image side to try, largest first
+RESOLUTIONS = [1024, 768, 512, 336]
+
+# (minimum useful, maximum) generated tokens per prompt variant, richest variant first
+TOKEN_LIMITS = {
+    'detailed': (200, 700),
+    'concise': (24, 80),
+}
+
+# A few fixed context sizes, so Ollama does not reload the model on every small change
+CONTEXT_SIZES = [2048, 4096, 8192]
+
+# Image token prior used to size num_ctx until prompt_eval_count has been seen: fixed-size
+# encoders like llava use 576 tokens, tiling ones like qwen2.5-vl about 1300 per megapixel
+IMAGE_TOKENS = 576
+IMAGE_TOKENS_PER_MP = 1300
+CHARS_PER_TOKEN = 4
+
+# Headroom on the estimated prompt length, so a low estimate does not get the prompt truncated
+CONTEXT_MARGIN = 1.25
+
+# Prompt evaluation prior, in seconds = base + per_mp * megapixels. It enters the fit as fixed
+# pseudo-observations at two image sizes, so it is never forgotten and holds the slope
+# whenever recent requests have all used the same resolution
+PRIOR_PROMPT_BASE = 1.0
+PRIOR_PROMPT_PER_MP = 1.5
+PRIOR_MEGAPIXELS = (0.1, 1.0)
+PRIOR_WEIGHT = 0.1
+
+# Ollama unloads a model after it has been idle this many seconds by default
+KEEP_ALIVE = 300
+
+
+def encode_image_to_base64(image):
+    """Convert PIL Image to base64 JPEG string"""
+    buffered = io.BytesIO()
+
+    # Convert RGBA to RGB for JPEG compatibility
+    if image.mode == 'RGBA':
+        # Create a white background
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.split()[-1])  # Use alpha channel as mask
+        image = background
+    elif image.mode not in ['RGB', 'L']:
+        image = image.convert('RGB')
+
+    image.save(buffered, format="JPEG")
+    return base64.b64encode(buffered.getvalue()).decode('utf-8')
+
+
+def format_budget_result(result):
+    """Response text followed by a one-line summary of the plan that produced it"""
+    plan = result['plan']
+    summary = (f"[{plan['variant']} prompt, {plan['size'][0]}x{plan['size'][1]}, "
+               f"num_predict={plan['num_predict']}, num_ctx={plan['num_ctx']}, "
+               f"predicted {plan['predicted']:.1f}s, took {result['elapsed']:.1f}s")
+    if result['stopped_early']:
+        summary += ", stopped early"
+    return f"{result['text']}\n\n{summary}]"
+
+
+def _abort_response(response):
+    """Close a streaming response so that a read blocked in another thread returns at once"""
+    # Closing alone leaves a blocked recv() waiting; shutting the socket down wakes it
+    sock = getattr(getattr(response.raw, '_connection', None), 'sock', None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    response.close()
+
+
+class LatencyModel:
+    """Running latency estimates for one (model, server) pair"""
+
+    def __init__(self, alpha=0.3):
+        self.alpha = alpha
+        self.samples = 0       # requests that finished with Ollama's timings
+        self.eval_samples = 0  # generation speed measurements, including cut-off streams
+
+        # Priors, replaced by measurements as requests complete
+        self.overhead = 0.5         # seconds spent outside prompt evaluation and generation
+        self.eval_per_token = 0.05  # seconds per generated token
+        self.prompt_base = PRIOR_PROMPT_BASE  # prompt evaluation is fitted as base + per_mp * megapixels
+        self.prompt_per_mp = PRIOR_PROMPT_PER_MP
+
+        # Exponentially decayed sums of measurements for the prompt fit: weight, x, y, x*x, x*y
+        self._fit = [0.0, 0.0, 0.0, 0.0, 0.0]
+
+        # Largest image token count seen per image size, from prompt_eval_count
+        self.image_tokens = {}
+
+        # num_ctx and time of the last request that showed the model loaded
+        self.loaded_num_ctx = None
+        self.loaded_at = None
+
+    def _blend(self, old, new, count):
+        if count == 0:
+            return new
+        return (1 - self.alpha) * old + self.alpha * new
+
+    def predict(self, megapixels, num_predict):
+        """Predicted seconds for a request with the given image size and generation length"""
+        return (self.overhead + self.prompt_base + self.prompt_per_mp * megapixels
+                + num_predict * self.eval_per_token)
+
+    def update_eval_rate(self, tokens, seconds):
+        """Record generation speed from a stream that was cut off before Ollama reported timings"""
+        if tokens > 0 and seconds > 0:
+            self.eval_per_token = self._blend(self.eval_per_token, seconds / tokens, self.eval_samples)
+            self.eval_samples += 1
+
+    def estimate_image_tokens(self, megapixels):
+        """Tokens the image is expected to take in the prompt, erring on the high side"""
+        key = round(megapixels, 3)
+        if key in self.image_tokens:
+            return self.image_tokens[key]
+        if self.image_tokens:
+            # Never below what was seen for a larger image, and scaled up linearly for a larger one
+            return max(tokens * max(1.0, megapixels / seen) for seen, tokens in self.image_tokens.items())
+        return max(IMAGE_TOKENS, IMAGE_TOKENS_PER_MP * megapixels)
+
+    def is_loaded(self, num_ctx, now):
+        """Whether a recent request showed the model loaded with this num_ctx
+
+        Changing num_ctx makes Ollama reload the model, and idle models are unloaded after KEEP_ALIVE.
+        """
+        return (self.loaded_num_ctx == num_ctx and self.loaded_at is not None
+                and now - self.loaded_at < KEEP_ALIVE)
+
+    def mark_loaded(self, num_ctx, now):
+        self.loaded_num_ctx = num_ctx
+        self.loaded_at = now
+
+    def update_first_token(self, megapixels, seconds, lower_bound=False):
+        """Learn prompt cost from a cut-off stream, given the seconds until its first token
+
+        When the stream timed out before any token arrived, seconds is the time waited and
+        lower_bound is set: it can push the prompt estimate up but never down. The wait also
+        includes any model load, so only call this when the model was already loaded.
+        """
+        prompt = max(0.0, seconds - self.overhead - self.eval_per_token)
+        if lower_bound and prompt <= self.prompt_base + self.prompt_per_mp * megapixels:
+            return
+        self.update_prompt(megapixels, prompt)
+
+    def update_prompt(self, megapixels, seconds):
+        """Refit the prompt evaluation line with a new measurement"""
+        decay = 1 - self.alpha
+        fit = [value * decay for value in self._fit]
+        fit[0] += 1
+        fit[1] += megapixels
+        fit[2] += seconds
+        fit[3] += megapixels * megapixels
+        fit[4] += megapixels * seconds
+        self._fit = fit
+
+        # Add the prior's pseudo-observations, which do not decay
+        weight, sum_x, sum_y, sum_xx, sum_xy = fit
+        for megapixels in PRIOR_MEGAPIXELS:
+            prior_weight = PRIOR_WEIGHT / len(PRIOR_MEGAPIXELS)
+            prior_seconds = PRIOR_PROMPT_BASE + PRIOR_PROMPT_PER_MP * megapixels
+            weight += prior_weight
+            sum_x += prior_weight * megapixels
+            sum_y += prior_weight * prior_seconds
+            sum_xx += prior_weight * megapixels * megapixels
+            sum_xy += prior_weight * megapixels * prior_seconds
+
+        mean_x = sum_x / weight
+        mean_y = sum_y / weight
+        variance = sum_xx / weight - mean_x * mean_x
+        self.prompt_per_mp = max(0.0, (sum_xy / weight - mean_x * mean_y) / variance)
+        self.prompt_base = max(0.0, mean_y - self.prompt_per_mp * mean_x)
+
+    def update(self, megapixels, timings, wall_seconds, text_tokens=0):
+        """Learn from the final chunk of a completed Ollama response (durations in nanoseconds)"""
+        load = timings.get('load_duration', 0) / 1e9
+        prompt = timings.get('prompt_eval_duration', 0) / 1e9
+        generated = timings.get('eval_duration', 0) / 1e9
+
+        # Ollama omits prompt timings when the prompt was served from cache
+        if timings.get('prompt_eval_count'):
+            self.update_prompt(megapixels, prompt)
+            key = round(megapixels, 3)
+            image_tokens = max(0, timings['prompt_eval_count'] - text_tokens)
+            self.image_tokens[key] = max(self.image_tokens.get(key, 0), image_tokens)
+        if timings.get('eval_count'):
+            self.update_eval_rate(timings['eval_count'], generated)
+
+        # Model loading is a one-off cost, so keep it out of the steady-state overhead
+        overhead = max(0.0, wall_seconds - load - prompt - generated)
+        self.overhead = self._blend(self.overhead, overhead, self.samples)
+        self.samples += 1
+
+
+class LatencyBudgetController:
+    """Plans and runs vision requests so they finish within a target latency"""
+
+    def __init__(self, safety=0.85):
+        self.safety = safety  # fraction of the budget the plan may use
+        self.models = {}
+        self.lock = threading.Lock()
+
+    def get_model(self, model, server):
+        key = (model, server.rstrip('/'))
+        with self.lock:
+            if key not in self.models:
+                self.models[key] = LatencyModel()
+            return self.models[key]
+
+    def plan(self, model, server, test_type, budget, image_size, context_length=None):
+        """Pick the richest request settings predicted to fit within budget seconds"""
+        latency = self.get_model(model, server)
+        usable = budget * self.safety
+        width, height = image_size
+
+        candidates = []
+        for variant, (min_tokens, max_tokens) in TOKEN_LIMITS.items():
+            seen = set()
+            for side in RESOLUTIONS:
+                scale = min(1.0, side / max(width, height))
+                size = (max(1, round(width * scale)), max(1, round(height * scale)))
+                if size in seen:
+                    continue
+                seen.add(size)
+                candidates.append((variant, size, min_tokens, max_tokens))
+
+        for variant, size, min_tokens, max_tokens in candidates:
+            megapixels = size[0] * size[1] / 1e6
+            remaining = usable - latency.predict(megapixels, 0)
+            num_predict = min(max_tokens, int(remaining / latency.eval_per_token))
+            if num_predict >= min_tokens:
+                break
+        else:
+            # Nothing fits: send the cheapest request and rely on the early stop
+            variant, size, min_tokens, max_tokens = candidates[-1]
+            megapixels = size[0] * size[1] / 1e6
+            num_predict = min_tokens
+
+        prompt = PROMPTS[test_type][variant]
+        prompt_tokens = latency.estimate_image_tokens(megapixels) + len(prompt) // CHARS_PER_TOKEN
+        needed = int(prompt_tokens * CONTEXT_MARGIN) + num_predict
+        num_ctx = next((n for n in CONTEXT_SIZES if n >= needed), CONTEXT_SIZES[-1])
+        if context_length:
+            # Never ask for more context than the model was trained with
+            num_ctx = min(num_ctx, context_length)
+
+        return {
+            'variant': variant,
+            'prompt': prompt,
+            'size': size,
+            'megapixels': megapixels,
+            'num_predict': num_predict,
+            'num_ctx': num_ctx,
+            'predicted': latency.predict(megapixels, num_predict),
+        }
+
+    def run(self, model, server, test_type, image, budget, context_length=None):
+        """Send a vision request planned for budget seconds, stopping generation before the deadline"""
+        start = time.monotonic()
+        deadline = start + budget
+        latency = self.get_model(model, server)
+        plan = self.plan(model, server, test_type, budget, image.size, context_length)
+        result = {'plan': plan, 'text': '', 'stopped_early': False, 'elapsed': 0.0}
+        with self.lock:
+            loaded = latency.is_loaded(plan['num_ctx'], start)
+
+        try:
+            if plan['size'] != image.size:
+                image = image.resize(plan['size'], Image.Resampling.LANCZOS)
+
+            payload = {
+                "model": model,
+                "prompt": plan['prompt'],
+                "stream": True,
+                "images": [encode_image_to_base64(image)],
+                "options": {
+                    "num_predict": plan['num_predict'],
+                    "num_ctx": plan['num_ctx'],
+                },
+            }
+
+            url = f"{server.rstrip('/')}/api/generate"
+            text_tokens = len(plan['prompt']) // CHARS_PER_TOKEN
+            pieces = []
+            tokens = 0
+            first_token = None
+            completed = False
+            deadline_hit = threading.Event()
+
+            try:
+                # Neither connecting nor waiting for the response may run past the deadline
+                remaining = max(0.1, deadline - time.monotonic())
+                response = requests.post(url, json=payload, stream=True, timeout=(min(5, remaining), remaining))
+                if response.status_code != 200:
+                    result['text'] = f"Error: HTTP {response.status_code} - {response.text}"
+                    response.close()
+                    return result
+
+                def abort():
+                    deadline_hit.set()
+                    _abort_response(response)
+
+                # The stream can stall after a token passed the check below, so cut it off at the deadline
+                timer = threading.Timer(max(0.0, deadline - time.monotonic()), abort)
+                timer.daemon = True
+                timer.start()
+                try:
+                    for line in response.iter_lines():
+                        if not line:
+                            continue
+                        chunk = json.loads(line)
+                        if 'error' in chunk:
+                            pieces.append(f"Error: {chunk['error']}")
+                            break
+
+                        now = time.monotonic()
+                        if chunk.get('response'):
+                            pieces.append(chunk['response'])
+                            tokens += 1
+                            if first_token is None:
+                                first_token = now
+
+                        if chunk.get('done'):
+                            completed = True
+                            with self.lock:
+                                latency.update(plan['megapixels'], chunk, now - start, text_tokens)
+                            break
+
+                        # Stop once the next token would land past the deadline
+                        if now + latency.eval_per_token > deadline:
+                            result['stopped_early'] = True
+                            break
+                except Exception:
+                    if not deadline_hit.is_set():
+                        raise
+                    result['stopped_early'] = True
+                finally:
+                    timer.cancel()
+                    # Closing the connection makes Ollama cancel any remaining generation
+                    response.close()
+
+            except requests.exceptions.ReadTimeout:
+                # No response headers before the deadline
+                result['stopped_early'] = True
+            except requests.exceptions.ConnectionError as e:
+                # requests wraps read timeouts while streaming in a ConnectionError
+                if not (e.args and isinstance(e.args[0], ReadTimeoutError)):
+                    raise
+                result['stopped_early'] = True
+
+            with self.lock:
+                now = time.monotonic()
+                # A token or a full budget of waiting means Ollama has loaded the model by now
+                if completed or result['stopped_early'] or first_token is not None:
+                    latency.mark_loaded(plan['num_ctx'], now)
+
+                if result['stopped_early']:
+                    if first_token is not None:
+                        latency.update_eval_rate(tokens - 1, now - first_token)
+                    # The wait for the first token includes any model load, which says nothing about prompt cost
+                    if loaded and first_token is not None:
+                        latency.update_first_token(plan['megapixels'], first_token - start)
+                    elif loaded:
+                        latency.update_first_token(plan['megapixels'], now - start, lower_bound=True)
+
+            result['text'] = ''.join(pieces) or 'No response received'
+
+        except Exception as e:
+            result['text'] = f"Error: {str(e)}"
+
+        finally:
+            result['elapsed'] = time.monotonic() - start
+
+        return result
@@ -8,6 +8,9 @@ import io
 import threading
 import os
 
+from latency_budget import LatencyBudgetController, PROMPTS, format_budget_result
+from model_registry import ModelRegistry
+
 class OllamaVisionTester:
     def __init__(self, root):
         self.root = root
@@ -22,6 +25,10 @@ class OllamaVisionTester:
         self.current_image = None
         self.image_path = None
         
+        # Model capabilities and latency budget mode
+        self.model_registry = ModelRegistry()
+        self.latency_controller = LatencyBudgetController()
+        
         # Setup UI
         self.setup_ui()
         
@@ -47,12 +54,17 @@ class OllamaVisionTester:
         
         ttk.Label(config_frame, text="Model:").grid(row=0, column=2, sticky=tk.W, padx=(20, 0))
         self.model_var = tk.StringVar(value=self.current_model)
-        self.model_combo = ttk.Combobox(config_frame, textvariable=self.model_var, width=15)
+        self.model_combo = ttk.Combobox(config_frame, textvariable=self.model_var, width=25)
         self.model_combo['values'] = ('llava', 'llava-13b', 'bakllava', 'moondream')
         self.model_combo.grid(row=0, column=3, sticky=tk.W, padx=(5, 0))
         
         ttk.Button(config_frame, text="Test Connection", command=self.test_connection).grid(row=0, column=4, padx=(20, 0))
         
+        self.budget_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(config_frame, text="Latency budget (s):", variable=self.budget_var).grid(row=1, column=0, columnspan=2, sticky=tk.W, pady=(5, 0))
+        self.budget_seconds = tk.DoubleVar(value=10.0)
+        ttk.Spinbox(config_frame, from_=2, to=60, increment=1, textvariable=self.budget_seconds, width=6).grid(row=1, column=2, sticky=tk.W, padx=(20, 0), pady=(5, 0))
+        
         # Left Panel - Image Selection
         left_frame = ttk.LabelFrame(main_frame, text="Image Selection", padding="10")
         left_frame.grid(row=1, column=0, sticky=(tk.W, tk.E, tk.N, tk.S), padx=(0, 10))
@@ -135,17 +147,22 @@ class OllamaVisionTester:
     def test_connection(self):
         def test_thread():
             try:
-                url = self.url_entry.get().rstrip('/')
-                response = requests.get(f"{url}/api/tags", timeout=5)
-                if response.status_code == 200:
-                    models = response.json().get('models', [])
-                    model_names = [model['name'].split(':')[0] for model in models]
-                    
-                    # Update model combo box
-                    self.root.after(0, lambda: self.update_models(model_names))
-                    self.root.after(0, lambda: self.status_var.set("Connection successful"))
-                else:
-                    self.root.after(0, lambda: self.status_var.set("Connection failed"))
+                # Always contact the server; unchanged models still skip /api/show
+                models = self.model_registry.get_models(self.url_entry.get(), refresh=True)
+                
+                # List vision models first, keeping full names so different sizes stay separate
+                model_names = [info['name'] for info in models if info['vision']]
+                model_names += [info['name'] for info in models if not info['vision']]
+                vision_count = sum(1 for info in models if info['vision'] and info['complete'])
+                unknown_count = sum(1 for info in models if not info['complete'])
+                status = f"Connection successful ({vision_count} vision models"
+                if unknown_count:
+                    status += f", capabilities unavailable for {unknown_count}"
+                status += ")"
+                
+                # Update model combo box
+                self.root.after(0, lambda: self.update_models(model_names))
+                self.root.after(0, lambda: self.status_var.set(status))
                     
             except Exception as e:
                 self.root.after(0, lambda: self.status_var.set(f"Connection error: {str(e)}"))
@@ -194,46 +211,39 @@ class OllamaVisionTester:
             messagebox.showwarning("Warning", "Please select an image first")
             return
             
-        prompt = """Analyze the colors in this image in detail. Please:
-1. List all the dominant colors you can identify
-2. Be specific about color shades and tones (e.g., "navy blue" instead of just "blue")
-3. Mention any color gradients or transitions
-4. Identify any color patterns or color schemes
-5. Estimate the percentage of each color in the image"""
-        
-        self.run_vision_test("Color Recognition", prompt)
+        self.run_vision_test("Color Recognition", 'color')
         
     def test_shape_recognition(self):
         if not self.image_path:
             messagebox.showwarning("Warning", "Please select an image first")
             return
             
-        prompt = """Identify and analyze all geometric shapes in this image. Please:
-1. List all shapes you can identify (circles, squares, triangles, rectangles, etc.)
-2. Describe their positions and locations relative to each other
-3. Estimate their sizes and proportions
-4. Identify any patterns or arrangements of shapes
-5. Note any complex shapes or combinations of basic shapes"""
-        
-        self.run_vision_test("Shape Recognition", prompt)
+        self.run_vision_test("Shape Recognition", 'shape')
         
     def test_general_vision(self):
         if not self.image_path:
             messagebox.showwarning("Warning", "Please select an image first")
             return
             
-        prompt = """Provide a comprehensive analysis of this image. Please describe:
-1. All objects and elements you can identify
-2. Colors and their distribution
-3. Shapes and geometric patterns
-4. Spatial relationships between elements
-5. Any text or symbols present
-6. Overall composition and style
-7. Notable details or interesting features"""
+        self.run_vision_test("General Vision Analysis", 'general')
         
-        self.run_vision_test("General Vision Analysis", prompt)
-        
-    def run_vision_test(self, test_name, prompt):
+    def send_budget_request(self, test_type, image_path):
+        """Send vision request planned to finish within the latency budget"""
+        try:
+            budget = self.budget_seconds.get()
+            with Image.open(image_path) as image:
+                image.load()
+            model = self.model_var.get()
+            # Only use capabilities already cached, so no lookup eats into the budget
+            info = self.model_registry.get_cached_model(self.url_entry.get(), model) or {}
+            context_length = info.get('context_length')
+            result = self.latency_controller.run(model, self.url_entry.get(), test_type, image, budget, context_length)
+        except Exception as e:
+            return f"Error: {str(e)}"
+            
+        return format_budget_result(result)
+            
+    def run_vision_test(self, test_name, test_type):
         def test_thread():
             # Update UI
             self.root.after(0, lambda: self.results_text.delete(1.0, tk.END))
@@ -241,7 +251,10 @@ class OllamaVisionTester:
             self.root.after(0, lambda: self.status_var.set(f"Running {test_name}..."))
             
             # Send request
-            result = self.send_vision_request(prompt, self.image_path)
+            if self.budget_var.get():
+                result = self.send_budget_request(test_type, self.image_path)
+            else:
+                result = self.send_vision_request(PROMPTS[test_type]['detailed'], self.image_path)
             
             # Display results
             self.root.after(0, lambda: self.display_results(test_name, result))
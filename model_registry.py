@@ -0,0 +1,127 @@
+"""
+Cached model capability discovery for Ollama servers
+Lists models with /api/tags and queries /api/show for each one concurrently,
+caching the results per server with a TTL and digest-based invalidation
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+# Model families that carry an image encoder, for servers too old to report capabilities
+VISION_FAMILIES = {'clip', 'mllama'}
+
+# Seconds to wait before asking /api/show again about a model it failed for
+SHOW_RETRY_DELAY = 10
+
+
+class ModelRegistry:
+    """Capabilities of the models installed on each Ollama server"""
+
+    def __init__(self, ttl=300, max_workers=8):
+        self.ttl = ttl  # seconds before /api/tags is checked again
+        self.max_workers = max_workers
+        self.servers = {}  # server url -> (fetched at, {model name: capabilities})
+        self.lock = threading.Lock()
+
+    def invalidate(self, server=None):
+        """Forget cached models for one server, or for all servers"""
+        with self.lock:
+            if server is None:
+                self.servers.clear()
+            else:
+                self.servers.pop(server.rstrip('/'), None)
+
+    def get_models(self, server, refresh=False):
+        """Return capability dicts for every model on the server, sorted by name"""
+        server = server.rstrip('/')
+        with self.lock:
+            fetched_at, cached = self.servers.get(server, (None, {}))
+        now = time.monotonic()
+        fresh = fetched_at is not None and now - fetched_at < self.ttl
+        # Models whose /api/show failed are retried once their delay has passed, even within the TTL
+        retry_due = any(not info['complete'] and info['retry_at'] <= now for info in cached.values())
+        if not refresh and fresh and not retry_due:
+            return sorted(cached.values(), key=lambda info: info['name'])
+
+        response = requests.get(f"{server}/api/tags", timeout=5)
+        response.raise_for_status()
+        tags = response.json().get('models', [])
+
+        # Only models that are new or were re-pulled under the same name need /api/show
+        models = {}
+        stale = []
+        for tag in tags:
+            previous = cached.get(tag['name'])
+            if (previous and previous['digest'] == tag.get('digest')
+                    and (previous['complete'] or (not refresh and previous['retry_at'] > now))):
+                models[tag['name']] = previous
+            else:
+                stale.append(tag)
+
+        if stale:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                for info in pool.map(lambda tag: self.show_model(server, tag), stale):
+                    models[info['name']] = info
+
+        with self.lock:
+            self.servers[server] = (time.monotonic(), models)
+        return sorted(models.values(), key=lambda info: info['name'])
+
+    def get_cached_model(self, server, name):
+        """Return cached capabilities for one model without contacting the server, or None"""
+        with self.lock:
+            _, cached = self.servers.get(server.rstrip('/'), (None, {}))
+            return cached.get(name)
+
+    def get_model(self, server, name):
+        """Return capabilities for one model, or None if the server does not have it"""
+        for info in self.get_models(server):
+            if info['name'] == name:
+                return info
+        return None
+
+    def vision_models(self, server):
+        """Names of the models that accept images"""
+        return [info['name'] for info in self.get_models(server) if info['vision']]
+
+    def show_model(self, server, tag):
+        """Build the capability entry for one /api/tags entry using /api/show"""
+        details = tag.get('details') or {}
+        info = {
+            'name': tag['name'],
+            'digest': tag.get('digest'),
+            'vision': any(family in VISION_FAMILIES for family in details.get('families') or []),
+            'parameter_size': details.get('parameter_size'),
+            'quantization': details.get('quantization_level'),
+            'context_length': None,
+            'complete': False,  # True once /api/show has confirmed the capabilities
+            'retry_at': None,   # when to ask /api/show again if it failed
+        }
+
+        try:
+            response = requests.post(f"{server}/api/show", json={"model": tag['name']}, timeout=10)
+            response.raise_for_status()
+            show = response.json()
+        except Exception:
+            # Keep the /api/tags details as a best guess until /api/show succeeds
+            info['retry_at'] = time.monotonic() + SHOW_RETRY_DELAY
+            return info
+
+        details = show.get('details') or details
+        info['parameter_size'] = details.get('parameter_size', info['parameter_size'])
+        info['quantization'] = details.get('quantization_level', info['quantization'])
+
+        if 'capabilities' in show:
+            info['vision'] = 'vision' in show['capabilities']
+        elif show.get('projector_info'):
+            info['vision'] = True
+
+        model_info = show.get('model_info') or {}
+        architecture = model_info.get('general.architecture')
+        info['context_length'] = model_info.get(f"{architecture}.context_length")
+        info['complete'] = True
+
+        return info
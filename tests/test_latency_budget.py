@@ -0,0 +1,312 @@
+"""
+Tests for the latency budget planner and its running latency model
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+import unittest
+from unittest import mock
+
+import requests
+from PIL import Image
+from urllib3.exceptions import ReadTimeoutError
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from latency_budget import CONTEXT_SIZES, KEEP_ALIVE, LatencyBudgetController, LatencyModel
+
+SERVER = "http://localhost:11434"
+IMAGE_SIZE = (2000, 1500)
+
+
+class PlanTests(unittest.TestCase):
+    def setUp(self):
+        self.controller = LatencyBudgetController()
+
+    def plan(self, budget, **kwargs):
+        return self.controller.plan('llava', SERVER, 'color', budget, IMAGE_SIZE, **kwargs)
+
+    def test_large_budget_uses_detailed_prompt_at_full_resolution(self):
+        plan = self.plan(60)
+        self.assertEqual(plan['variant'], 'detailed')
+        self.assertEqual(plan['size'], (1024, 768))
+
+    def test_shrinking_budget_steps_down(self):
+        # Ordered from richest to cheapest: detailed before concise, larger images first
+        variants = ['detailed', 'concise']
+        previous = (0, -float('inf'))
+        for budget in [60, 20, 14, 12, 11, 5, 3.5, 3]:
+            plan = self.plan(budget)
+            rank = (variants.index(plan['variant']), -plan['size'][0])
+            self.assertGreaterEqual(rank, previous, f"budget {budget}s chose {plan['variant']} {plan['size']}")
+            previous = rank
+        self.assertEqual(self.plan(3)['variant'], 'concise')
+        self.assertLess(self.plan(3)['size'][0], 1024)
+
+    def test_plans_fit_the_budget(self):
+        for budget in [60, 20, 10, 5, 3.5]:
+            plan = self.plan(budget)
+            self.assertLessEqual(plan['predicted'], budget * self.controller.safety)
+
+    def test_impossible_budget_falls_back_to_cheapest_request(self):
+        plan = self.plan(0.5)
+        self.assertEqual(plan['variant'], 'concise')
+        self.assertEqual(plan['size'], (336, 252))
+
+    def test_small_image_is_never_upscaled(self):
+        plan = self.controller.plan('llava', SERVER, 'color', 60, (200, 100))
+        self.assertEqual(plan['size'], (200, 100))
+
+    def test_num_ctx_uses_fixed_sizes_capped_by_model(self):
+        self.assertIn(self.plan(60)['num_ctx'], CONTEXT_SIZES)
+        self.assertEqual(self.plan(60, context_length=1024)['num_ctx'], 1024)
+
+    def test_num_ctx_follows_learned_image_tokens(self):
+        latency = self.controller.get_model('llava', SERVER)
+        megapixels = self.plan(60)['megapixels']
+
+        # llava-style fixed image tokens fit the detailed answer in the smallest context
+        latency.image_tokens = {round(megapixels, 3): 576}
+        self.assertEqual(self.plan(60)['num_ctx'], 2048)
+
+        # A tiling encoder needs a larger context for the same answer
+        latency.image_tokens = {round(megapixels, 3): 1300}
+        self.assertEqual(self.plan(60)['num_ctx'], 4096)
+
+    def test_image_token_prior_leaves_room_for_tiling_encoders(self):
+        plan = self.plan(60)
+        self.assertEqual(plan['num_predict'], 700)
+        self.assertGreaterEqual(plan['num_ctx'], 1300 * plan['megapixels'] + plan['num_predict'])
+
+
+class LatencyModelTests(unittest.TestCase):
+    def test_prompt_fit_converges(self):
+        latency = LatencyModel()
+        for _ in range(10):
+            for megapixels in [0.08, 0.2, 0.44, 0.79]:
+                latency.update_prompt(megapixels, 0.5 + 4.0 * megapixels)
+        # The prior keeps a small, fixed weight in the fit
+        for megapixels in [0.08, 0.2, 0.44, 0.79]:
+            self.assertAlmostEqual(latency.predict(megapixels, 0) - latency.overhead,
+                                   0.5 + 4.0 * megapixels, delta=0.1)
+
+    def test_slope_recovers_after_outlier_at_single_resolution(self):
+        latency = LatencyModel()
+        latency.update_prompt(0.44, 7.0)
+        for _ in range(40):
+            latency.update_prompt(0.79, 0.5 + 1.0 * 0.79)
+        self.assertLess(latency.prompt_per_mp, 2.0)
+        self.assertAlmostEqual(latency.predict(0.79, 0) - latency.overhead, 1.29, delta=0.05)
+
+    def test_completed_requests_learn_all_terms(self):
+        latency = LatencyModel()
+        timings = {
+            'load_duration': 0,
+            'prompt_eval_count': 600,
+            'prompt_eval_duration': int(2e9),
+            'eval_count': 100,
+            'eval_duration': int(3e9),
+        }
+        for _ in range(20):
+            latency.update(0.79, timings, 5.25)
+        self.assertAlmostEqual(latency.eval_per_token, 0.03)
+        self.assertAlmostEqual(latency.overhead, 0.25)
+        self.assertAlmostEqual(latency.predict(0.79, 0), 2.25, delta=0.02)
+        self.assertEqual(latency.estimate_image_tokens(0.79), 600)
+
+    def test_loaded_state_expires_and_follows_num_ctx(self):
+        latency = LatencyModel()
+        self.assertFalse(latency.is_loaded(2048, 100.0))
+        latency.mark_loaded(2048, 100.0)
+        self.assertTrue(latency.is_loaded(2048, 101.0))
+        self.assertFalse(latency.is_loaded(4096, 101.0))
+        self.assertFalse(latency.is_loaded(2048, 100.0 + KEEP_ALIVE))
+
+    def test_cut_off_streams_learn_prompt_cost(self):
+        # A slow server where every request is cut off before Ollama reports timings
+        latency = LatencyModel()
+        for _ in range(10):
+            latency.update_first_token(0.79, 6.5)
+        self.assertGreater(latency.predict(0.79, 0), 6.0)
+
+    def test_eval_rate_is_smoothed_without_completed_requests(self):
+        latency = LatencyModel()
+        latency.update_eval_rate(10, 1.0)
+        self.assertAlmostEqual(latency.eval_per_token, 0.1)
+        latency.update_eval_rate(10, 2.0)
+        self.assertAlmostEqual(latency.eval_per_token, 0.7 * 0.1 + 0.3 * 0.2)
+
+    def test_slow_prompt_moves_plan_down(self):
+        controller = LatencyBudgetController()
+        before = controller.plan('llava', SERVER, 'color', 8, IMAGE_SIZE)
+        latency = controller.get_model('llava', SERVER)
+        for _ in range(5):
+            latency.update_first_token(before['megapixels'], 6.5)
+        after = controller.plan('llava', SERVER, 'color', 8, IMAGE_SIZE)
+        self.assertLess(after['megapixels'], before['megapixels'])
+
+
+class FakeStream:
+    """Streaming response that plays back a script of chunks, pauses and errors"""
+
+    def __init__(self, script, status_code=200, text=''):
+        self.script = script
+        self.status_code = status_code
+        self.text = text
+        self.raw = None
+        self.closed = threading.Event()
+
+    def iter_lines(self):
+        for step in self.script:
+            if step == 'stall':
+                # Block like a socket read until the response is closed
+                self.closed.wait(5)
+                raise requests.exceptions.ChunkedEncodingError("Response ended prematurely")
+            if isinstance(step, float):
+                time.sleep(step)
+            elif isinstance(step, Exception):
+                raise step
+            else:
+                yield json.dumps(step).encode()
+
+    def close(self):
+        self.closed.set()
+
+
+def token(text='w '):
+    return {'response': text, 'done': False}
+
+
+def done(eval_count=2):
+    return {
+        'response': '',
+        'done': True,
+        'prompt_eval_count': 700,
+        'prompt_eval_duration': int(0.2e9),
+        'eval_count': eval_count,
+        'eval_duration': int(eval_count * 0.01e9),
+    }
+
+
+class RunTests(unittest.TestCase):
+    def setUp(self):
+        self.controller = LatencyBudgetController()
+        self.latency = self.controller.get_model('llava', SERVER)
+        self.image = Image.new('RGB', (200, 150), 'red')
+
+    def run_with(self, post, budget=5):
+        with mock.patch('latency_budget.requests.post', post):
+            return self.controller.run('llava', SERVER, 'color', self.image, budget)
+
+    def stream(self, *script):
+        return mock.Mock(return_value=FakeStream(list(script)))
+
+    def mark_loaded(self, budget=5):
+        plan = self.controller.plan('llava', SERVER, 'color', budget, self.image.size)
+        self.latency.mark_loaded(plan['num_ctx'], time.monotonic())
+
+    def test_completed_stream(self):
+        post = self.stream(token('red '), token('and blue'), done())
+        result = self.run_with(post)
+        self.assertEqual(result['text'], 'red and blue')
+        self.assertFalse(result['stopped_early'])
+        self.assertEqual(self.latency.samples, 1)
+        self.assertGreater(self.latency.estimate_image_tokens(result['plan']['megapixels']), 600)
+        self.assertTrue(self.latency.is_loaded(result['plan']['num_ctx'], time.monotonic()))
+
+        options = post.call_args.kwargs['json']['options']
+        self.assertEqual(options['num_predict'], result['plan']['num_predict'])
+        self.assertTrue(post.call_args.kwargs['stream'])
+
+    def test_stops_before_next_token_would_miss_deadline(self):
+        self.latency.eval_per_token = 0.05
+        script = [item for _ in range(100) for item in (token(), 0.05)]
+        result = self.run_with(self.stream(*script), budget=0.5)
+        self.assertTrue(result['stopped_early'])
+        self.assertTrue(result['text'].startswith('w '))
+        self.assertLess(result['elapsed'], 0.6)
+        self.assertEqual(self.latency.eval_samples, 1)
+
+    def test_stalled_stream_is_cut_off_at_deadline(self):
+        result = self.run_with(self.stream(token('partial'), 'stall'), budget=0.5)
+        self.assertTrue(result['stopped_early'])
+        self.assertEqual(result['text'], 'partial')
+        self.assertLess(result['elapsed'], 1.0)
+
+    def test_read_timeout_before_headers(self):
+        self.mark_loaded(budget=1.5)
+        self.latency.overhead = 0.0
+        before = self.latency.predict(0.03, 0)
+
+        def post(url, **kwargs):
+            time.sleep(kwargs['timeout'][1])
+            raise requests.exceptions.ReadTimeout("Read timed out")
+
+        post = mock.Mock(side_effect=post)
+        result = self.run_with(post, budget=1.5)
+        self.assertTrue(result['stopped_early'])
+        self.assertEqual(result['text'], 'No response received')
+        self.assertGreater(self.latency.predict(0.03, 0), before)
+
+        # The read timeout never runs past the budget
+        connect_timeout, read_timeout = post.call_args.kwargs['timeout']
+        self.assertLessEqual(connect_timeout, 1.5)
+        self.assertLessEqual(read_timeout, 1.5)
+
+    def test_early_timeout_never_lowers_prompt_estimate(self):
+        self.mark_loaded()
+        before = (self.latency.prompt_base, self.latency.prompt_per_mp)
+        post = mock.Mock(side_effect=requests.exceptions.ReadTimeout("Read timed out"))
+        self.run_with(post)
+        self.assertEqual((self.latency.prompt_base, self.latency.prompt_per_mp), before)
+
+    def test_connect_timeout_is_capped_by_budget(self):
+        post = self.stream(done(0))
+        self.run_with(post, budget=2)
+        connect_timeout, read_timeout = post.call_args.kwargs['timeout']
+        self.assertLessEqual(connect_timeout, 2)
+        self.assertLessEqual(read_timeout, 2)
+
+    def test_read_timeout_while_streaming_keeps_partial_text(self):
+        self.mark_loaded()
+        timeout = requests.exceptions.ConnectionError(ReadTimeoutError(None, SERVER, "Read timed out."))
+        result = self.run_with(self.stream(token('some '), token('text'), timeout))
+        self.assertTrue(result['stopped_early'])
+        self.assertEqual(result['text'], 'some text')
+        self.assertEqual(self.latency.eval_samples, 1)
+
+    def test_cut_off_teaches_prompt_cost_only_when_model_was_loaded(self):
+        before = (self.latency.prompt_base, self.latency.prompt_per_mp)
+
+        # The first request may have waited for a model load
+        result = self.run_with(self.stream(token(), 'stall'), budget=0.3)
+        self.assertTrue(result['stopped_early'])
+        self.assertEqual((self.latency.prompt_base, self.latency.prompt_per_mp), before)
+
+        # Its first token showed the model loaded, so the next cut-off is learned from
+        self.run_with(self.stream(token(), 'stall'), budget=0.3)
+        self.assertNotEqual((self.latency.prompt_base, self.latency.prompt_per_mp), before)
+
+    def test_other_connection_errors_are_reported(self):
+        post = mock.Mock(side_effect=requests.exceptions.ConnectionError("Connection refused"))
+        result = self.run_with(post)
+        self.assertFalse(result['stopped_early'])
+        self.assertEqual(result['text'], 'Error: Connection refused')
+
+    def test_http_error(self):
+        post = mock.Mock(return_value=FakeStream([], status_code=500, text='boom'))
+        result = self.run_with(post)
+        self.assertEqual(result['text'], 'Error: HTTP 500 - boom')
+        self.assertGreater(result['elapsed'], 0)
+
+    def test_error_chunk(self):
+        result = self.run_with(self.stream({'error': 'model not found'}))
+        self.assertEqual(result['text'], 'Error: model not found')
+        self.assertFalse(result['stopped_early'])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,126 @@
+"""
+Tests for cached model capability discovery
+"""
+
+import os
+import sys
+import time
+import unittest
+from unittest import mock
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from model_registry import SHOW_RETRY_DELAY, ModelRegistry
+
+SERVER = "http://localhost:11434"
+
+
+class FakeOllama:
+    """Answers /api/tags and /api/show like an Ollama server, recording the calls"""
+
+    def __init__(self):
+        self.tags = [
+            {'name': 'llava:7b', 'digest': 'a', 'details': {'families': ['llama', 'clip']}},
+            {'name': 'llama3:8b', 'digest': 'b', 'details': {'families': ['llama']}},
+        ]
+        self.calls = []
+        self.down = False
+        self.show_fails = set()
+
+    def response(self, payload):
+        response = mock.Mock()
+        response.json.return_value = payload
+        response.raise_for_status.return_value = None
+        return response
+
+    def get(self, url, timeout=None):
+        if self.down:
+            raise requests.exceptions.ConnectionError("server down")
+        self.calls.append('tags')
+        return self.response({'models': self.tags})
+
+    def post(self, url, json=None, timeout=None):
+        name = json['model']
+        self.calls.append(name)
+        if self.down or name in self.show_fails:
+            raise requests.exceptions.ConnectionError("show failed")
+        return self.response({
+            'details': {'parameter_size': '7B', 'quantization_level': 'Q4_0'},
+            'capabilities': ['completion', 'vision'] if 'llava' in name else ['completion'],
+            'model_info': {'general.architecture': 'llama', 'llama.context_length': 4096},
+        })
+
+
+class ModelRegistryTests(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeOllama()
+        patcher = mock.patch.multiple('model_registry.requests', get=self.server.get, post=self.server.post)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.registry = ModelRegistry(ttl=300)
+
+    def test_reports_capabilities_from_show(self):
+        models = {info['name']: info for info in self.registry.get_models(SERVER)}
+        self.assertTrue(models['llava:7b']['vision'])
+        self.assertFalse(models['llama3:8b']['vision'])
+        self.assertEqual(models['llava:7b']['context_length'], 4096)
+        self.assertTrue(models['llava:7b']['complete'])
+
+    def test_cached_within_ttl(self):
+        self.registry.get_models(SERVER)
+        self.server.calls.clear()
+        self.registry.get_models(SERVER)
+        self.assertEqual(self.server.calls, [])
+
+    def test_refresh_contacts_server_and_only_shows_changed_models(self):
+        self.registry.get_models(SERVER)
+        self.server.calls.clear()
+        self.server.tags[1]['digest'] = 'b2'
+        self.registry.get_models(SERVER, refresh=True)
+        self.assertEqual(self.server.calls, ['tags', 'llama3:8b'])
+
+    def test_refresh_fails_when_server_is_down(self):
+        self.registry.get_models(SERVER)
+        self.server.down = True
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            self.registry.get_models(SERVER, refresh=True)
+
+    def test_failed_show_is_marked_and_retried_after_delay(self):
+        self.server.show_fails.add('llava:7b')
+        models = {info['name']: info for info in self.registry.get_models(SERVER)}
+        self.assertFalse(models['llava:7b']['complete'])
+        self.assertIsNone(models['llava:7b']['context_length'])
+
+        # Within the retry delay the cache still answers
+        self.server.show_fails.clear()
+        self.server.calls.clear()
+        self.registry.get_models(SERVER)
+        self.assertEqual(self.server.calls, [])
+
+        # Once the delay has passed the failed model is retried, well before the TTL
+        later = time.monotonic() + SHOW_RETRY_DELAY + 1
+        with mock.patch('model_registry.time.monotonic', return_value=later):
+            models = {info['name']: info for info in self.registry.get_models(SERVER)}
+        self.assertEqual(self.server.calls, ['tags', 'llava:7b'])
+        self.assertTrue(models['llava:7b']['complete'])
+
+    def test_refresh_retries_failed_show_immediately(self):
+        self.server.show_fails.add('llava:7b')
+        self.registry.get_models(SERVER)
+        self.server.show_fails.clear()
+        self.server.calls.clear()
+        self.registry.get_models(SERVER, refresh=True)
+        self.assertEqual(self.server.calls, ['tags', 'llava:7b'])
+
+    def test_cached_model_never_contacts_server(self):
+        self.assertIsNone(self.registry.get_cached_model(SERVER, 'llava:7b'))
+        self.registry.get_models(SERVER)
+        self.server.down = True
+        self.assertEqual(self.registry.get_cached_model(SERVER + '/', 'llava:7b')['context_length'], 4096)
+        self.assertIsNone(self.registry.get_cached_model(SERVER, 'missing'))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,12 +5,23 @@ A Streamlit application for testing Ollama vision capabilities
 
 import streamlit as st
 import requests
-import base64
 import json
 from PIL import Image
-import io
 import time
 
+from latency_budget import LatencyBudgetController, PROMPTS, format_budget_result, encode_image_to_base64
+from model_registry import ModelRegistry
+
+@st.cache_resource
+def get_model_registry():
+    """Model registry shared by every session of this server process"""
+    return ModelRegistry()
+
+@st.cache_resource
+def get_latency_controller():
+    """Latency models shared by every session of this server process"""
+    return LatencyBudgetController()
+
 class OllamaVisionWebTester:
     def __init__(self):
         self.setup_page()
@@ -25,19 +36,7 @@ class OllamaVisionWebTester:
         
     def encode_image_to_base64(self, image):
         """Convert PIL Image to base64 string"""
-        buffered = io.BytesIO()
-        
-        # Convert RGBA to RGB for JPEG compatibility
-        if image.mode == 'RGBA':
-            # Create a white background
-            background = Image.new('RGB', image.size, (255, 255, 255))
-            background.paste(image, mask=image.split()[-1])  # Use alpha channel as mask
-            image = background
-        elif image.mode not in ['RGB', 'L']:
-            image = image.convert('RGB')
-            
-        image.save(buffered, format="JPEG")
-        return base64.b64encode(buffered.getvalue()).decode('utf-8')
+        return encode_image_to_base64(image)
         
     def send_vision_request(self, prompt, base64_image, model):
         """Send vision request to Ollama"""
@@ -62,52 +61,61 @@ class OllamaVisionWebTester:
         except Exception as e:
             return f"Error: {str(e)}"
             
+    def store_models(self, models):
+        """Store all models, vision models and their capabilities for the pickers"""
+        st.session_state['all_models'] = [info['name'] for info in models]
+        st.session_state['vision_models'] = [info['name'] for info in models if info['vision'] and info['complete']]
+        st.session_state['model_info'] = {info['name']: info for info in models}
+        
     def test_connection(self):
         """Test connection to Ollama server"""
         try:
-            url = f"{st.session_state.get('ollama_url', 'http://localhost:11434')}/api/tags"
-            response = requests.get(url, timeout=5)
+            # Always contact the server; unchanged models still skip /api/show
+            url = st.session_state.get('ollama_url', 'http://localhost:11434')
+            models = get_model_registry().get_models(url, refresh=True)
+            self.store_models(models)
             
-            if response.status_code == 200:
-                models = response.json().get('models', [])
-                all_models = []
-                vision_models = []
-                
-                for model in models:
-                    # Use full model name (including version)
-                    full_name = model['name']
-                    all_models.append(full_name)
-                    
-                    # Also identify likely vision models
-                    if any(v in full_name.lower() for v in ['llava', 'bakllava', 'moondream', 'vision', 'clip', 'multimodal']):
-                        vision_models.append(full_name)
-                
-                # Store both all models and vision models
-                st.session_state['all_models'] = all_models
-                st.session_state['vision_models'] = vision_models
-                
-                return True, all_models
-            else:
-                return False, str(e)
+            return True, st.session_state['all_models']
                 
         except Exception as e:
             return False, str(e)
             
+    def load_cached_models(self):
+        """Fill the model picker from the shared registry once per session"""
+        if st.session_state.get('models_loaded'):
+            return
+        st.session_state['models_loaded'] = True
+        
+        try:
+            url = st.session_state.get('ollama_url', 'http://localhost:11434')
+            self.store_models(get_model_registry().get_models(url))
+        except Exception:
+            pass  # Keep the default model list until the connection is tested
+            
     def run_color_test(self, base64_image, model):
         """Run color recognition test"""
-        prompt = "What are the main colors in this image? List them in a single sentence."
+        prompt = PROMPTS['color']['concise']
         return self.send_vision_request(prompt, base64_image, model)
         
     def run_shape_test(self, base64_image, model):
         """Run shape recognition test"""
-        prompt = "What geometric shapes do you see in this image? Describe them in one sentence."
+        prompt = PROMPTS['shape']['concise']
         return self.send_vision_request(prompt, base64_image, model)
         
     def run_general_test(self, base64_image, model):
         """Run general vision analysis"""
-        prompt = "Briefly describe what you see in this image in one or two sentences."
+        prompt = PROMPTS['general']['concise']
         return self.send_vision_request(prompt, base64_image, model)
         
+    def run_budget_test(self, test_type, image, model, budget):
+        """Run a test planned to finish within the latency budget"""
+        # Only use capabilities already cached, so no lookup eats into the budget
+        server = st.session_state.get('ollama_url', 'http://localhost:11434')
+        info = get_model_registry().get_cached_model(server, model) or {}
+        
+        result = get_latency_controller().run(model, server, test_type, image, budget, info.get('context_length'))
+        return format_budget_result(result)
+        
     def run(self):
         st.title("👁️ Ollama Vision Capabilities Tester")
         st.markdown("Test and showcase the computer vision capabilities of Ollama AI models")
@@ -138,15 +146,16 @@ class OllamaVisionWebTester:
                         st.info(f"Found {len(result)} total models")
                         vision_models = st.session_state.get('vision_models', [])
                         if vision_models:
-                            st.info(f"Likely vision models: {', '.join(vision_models)}")
+                            st.info(f"Vision models: {', '.join(vision_models)}")
                         else:
-                            st.warning("No obvious vision models detected, but you can try any model")
+                            st.warning("No vision models detected, but you can try any model")
                     else:
                         st.warning("No models found. Make sure to pull a model first")
                 else:
                     st.error(f"❌ Connection failed: {result}")
             
             # Model dropdown - show all models
+            self.load_cached_models()
             available_models = st.session_state.get('all_models', ['llava:13b', 'llava', 'llava-13b', 'bakllava', 'moondream'])
             selected_model = st.selectbox(
                 "Select Model (All Available Models)",
@@ -155,11 +164,37 @@ class OllamaVisionWebTester:
             )
             
             # Show vision model indicator
-            vision_models = st.session_state.get('vision_models', [])
-            if selected_model in vision_models:
-                st.success("👁️ This is likely a vision model")
+            info = st.session_state.get('model_info', {}).get(selected_model)
+            if info is None:
+                st.info("ℹ️ Test the connection to check this model's capabilities")
+            elif not info['complete']:
+                st.warning("⚠️ Could not read this model's capabilities from the server, but you can try it")
+            elif info['vision']:
+                st.success("👁️ This is a vision model")
             else:
-                st.info("ℹ️ This may not be a vision model, but you can try it")
+                st.info("ℹ️ This model does not report vision support, but you can try it")
+            
+            if info:
+                details = [f"**{label}:** {info[key]}" for label, key in
+                           [("Parameters", 'parameter_size'), ("Quantization", 'quantization'),
+                            ("Context length", 'context_length')] if info[key]]
+                if details:
+                    st.caption(" | ".join(details))
+            
+            # Latency budget mode
+            st.subheader("Latency Budget")
+            budget_mode = st.checkbox(
+                "⏱️ Latency budget mode",
+                help="Tune resolution, response length and prompt detail to finish within a target time"
+            )
+            target_latency = st.slider(
+                "Target latency (seconds)",
+                min_value=2.0,
+                max_value=60.0,
+                value=10.0,
+                step=1.0,
+                disabled=not budget_mode
+            )
         
         # Main content area
         col1, col2 = st.columns([1, 1])
@@ -182,6 +217,7 @@ class OllamaVisionWebTester:
                 # Convert to base64
                 base64_image = self.encode_image_to_base64(image)
                 st.session_state['base64_image'] = base64_image
+                st.session_state['image'] = image
                 st.session_state['image_uploaded'] = True
                 
                 # Image info
@@ -201,20 +237,29 @@ class OllamaVisionWebTester:
             if st.session_state.get('image_uploaded', False):
                 test_col1, test_col2, test_col3 = st.columns(3)
                 
+                if budget_mode:
+                    image_arg = st.session_state['image']
+                    color_test = lambda image, model: self.run_budget_test('color', image, model, target_latency)
+                    shape_test = lambda image, model: self.run_budget_test('shape', image, model, target_latency)
+                    general_test = lambda image, model: self.run_budget_test('general', image, model, target_latency)
+                else:
+                    image_arg = st.session_state['base64_image']
+                    color_test, shape_test, general_test = self.run_color_test, self.run_shape_test, self.run_general_test
+                
                 with test_col1:
                     if st.button("🎨 Color Test", type="primary", use_container_width=True):
-                        self.run_test_with_progress("Color Recognition", self.run_color_test, 
-                                                   st.session_state['base64_image'], selected_model)
+                        self.run_test_with_progress("Color Recognition", color_test, 
+                                                   image_arg, selected_model)
                 
                 with test_col2:
                     if st.button("📐 Shape Test", type="primary", use_container_width=True):
-                        self.run_test_with_progress("Shape Recognition", self.run_shape_test,
-                                                   st.session_state['base64_image'], selected_model)
+                        self.run_test_with_progress("Shape Recognition", shape_test,
+                                                   image_arg, selected_model)
                 
                 with test_col3:
                     if st.button("🔍 General Test", type="primary", use_container_width=True):
-                        self.run_test_with_progress("General Vision", self.run_general_test,
-                                                   st.session_state['base64_image'], selected_model)
+                        self.run_test_with_progress("General Vision", general_test,
+                                                   image_arg, selected_model)
             else:
                 st.warning("Please upload an image first")
             